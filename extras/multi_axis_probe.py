@@ -1,7 +1,7 @@
 import logging
 import pins
 
-direction_types = {'x+': [0, +1], 'x-': [0, -1], 'y+': [1, +1], 'y-': [1, -1], 'z+': [2, +1], 'z-': [2, -1]}
+direction_types = {'x+': (0, +1), 'x-': (0, -1), 'y+': (1, +1), 'y-': (1, -1), 'z+': (2, +1), 'z-': (2, -1)}
 
 HINT_TIMEOUT = """
 If the probe did not move far enough to trigger, then
@@ -10,36 +10,71 @@ can travel further (the Z minimum position can be negative).
 """
 
 
+def calc_probe_mean(positions):
+    if len(positions) == 1:
+        return list(positions[0])
+    sum_x = sum_y = sum_z = 0.
+    for pos in positions:
+        sum_x += pos[0]
+        sum_y += pos[1]
+        sum_z += pos[2]
+    count = float(len(positions))
+    return [sum_x / count, sum_y / count, sum_z / count]
+
+def calc_probe_median(positions, axis):
+    if len(positions) == 1:
+        return list(positions[0])
+    axis_sorted = sorted(positions, key=(lambda p: p[axis]))
+    middle = len(positions) // 2
+    if (len(positions) & 1) == 1:
+        # odd number of samples
+        return axis_sorted[middle]
+    # even number of samples
+    low, high = axis_sorted[middle - 1], axis_sorted[middle]
+    return [(low[i] + high[i]) * .5 for i in range(3)]
+
+
 class ProbeCommandHelper:
     def __init__(self, config, probe, query_endstop=None):
         self.printer = config.get_printer()
         self.probe = probe
         self.query_endstop = query_endstop
         self.name = config.get_name()
+        self.toolhead = None
         gcode = self.printer.lookup_object('gcode')
         self.last_state = False
         gcode.register_command('QUERY_PROBE', self.cmd_QUERY_PROBE, desc=self.cmd_QUERY_PROBE_help)
         self.last_z_result = 0.
         gcode.register_command('PROBE', self.cmd_PROBE, desc=self.cmd_PROBE_help)
         gcode.register_command('PROBE_ACCURACY', self.cmd_PROBE_ACCURACY, desc=self.cmd_PROBE_ACCURACY_help)
+        self.printer.register_event_handler('klippy:connect', self._handle_connect)
+        self._update_status()
+
+    def _handle_connect(self):
+        self.toolhead = self.printer.lookup_object('toolhead')
 
     def _move(self, coord, speed):
-        self.printer.lookup_object('toolhead').manual_move(coord, speed)
+        self.toolhead.manual_move(coord, speed)
+
+    def _update_status(self):
+        # Status dicts must not be modified once returned, so build a
+        # new one whenever a value is set
+        self.status = {'name': self.name,
+                       'last_query': self.last_state,
+                       'last_z_result': self.last_z_result}
 
     def get_status(self, eventtime):
-        return {'name': self.name,
-                'last_query': self.last_state,
-                'last_z_result': self.last_z_result}
+        return self.status
 
     cmd_QUERY_PROBE_help = "Return the status of the z-probe"
     def cmd_QUERY_PROBE(self, gcmd):
         if self.query_endstop is None:
             raise gcmd.error("Probe does not support QUERY_PROBE")
-        toolhead = self.printer.lookup_object('toolhead')
-        print_time = toolhead.get_last_move_time()
+        print_time = self.toolhead.get_last_move_time()
         res = self.query_endstop(print_time)
         self.last_state = res
-        gcmd.respond_info("probe: %s" % (["open", "TRIGGERED"][not not res],))
+        self._update_status()
+        gcmd.respond_info("probe: %s" % ("TRIGGERED" if res else "open",))
 
     cmd_PROBE_help = "Probe Z-height at current XY position"
     def cmd_PROBE(self, gcmd):
@@ -47,53 +82,65 @@ class ProbeCommandHelper:
         pos = run_single_probe(self.probe, gcmd, direction)
         gcmd.respond_info(f"Result is {pos[0]}, {pos[1]}, {pos[2]}")
         self.last_z_result = pos[2]
+        self._update_status()
 
     cmd_PROBE_ACCURACY_help = "Probe Z-height accuracy at current XY position"
     def cmd_PROBE_ACCURACY(self, gcmd):
         params = self.probe.get_probe_params(gcmd)
         direction = gcmd.get("DIRECTION", 'z-')
-        (axis, sense) = direction_types[direction]
+        axis_sense = direction_types.get(direction)
+        if axis_sense is None:
+            raise self.printer.command_error("Wrong value for DIRECTION.")
+        (axis, sense) = axis_sense
         sample_count = gcmd.get_int("SAMPLES", 10, minval=1)
-        toolhead = self.printer.lookup_object('toolhead')
+        sample_retract_dist = params['sample_retract_dist']
+        lift_speed = params['lift_speed']
+        toolhead = self.toolhead
         pos = toolhead.get_position()
         gcmd.respond_info("PROBE_ACCURACY at X:%.3f Y:%.3f Z:%.3f"
                           " (samples=%d retract=%.3f"
                           " speed=%.1f lift_speed=%.1f)\n"
                           % (pos[0], pos[1], pos[2],
-                             sample_count, params['sample_retract_dist'],
-                             params['probe_speed'], params['lift_speed']))
-        # Create dummy gcmd with SAMPLES=1
-        fo_params = dict(gcmd.get_command_parameters())
-        fo_params['SAMPLES'] = '1'
-        gcode = self.printer.lookup_object('gcode')
-        fo_gcmd = gcode.create_gcode_command("", "", fo_params)
+                             sample_count, sample_retract_dist,
+                             params['probe_speed'], lift_speed))
+        # Reuse the parsed parameters for each single sample probe
+        fo_params = dict(params)
+        fo_params['samples'] = 1
         # Probe bed sample_count times
-        probe_session = self.probe.start_probe_session(fo_gcmd, direction)
+        probe_session = self.probe.start_probe_session(gcmd, direction)
         probe_num = 0
         while probe_num < sample_count:
             # Probe position
-            probe_session.run_probe(fo_gcmd, direction)
+            probe_session.run_probe_with_params(gcmd, fo_params, direction)
             probe_num += 1
             # Retract
             pos = toolhead.get_position()
             liftpos = pos
-            liftpos[axis] = pos[axis] - sense * params['sample_retract_dist']
-            toolhead.manual_move(liftpos, params['lift_speed'])
+            liftpos[axis] = pos[axis] - sense * sample_retract_dist
+            toolhead.manual_move(liftpos, lift_speed)
             gcmd.respond_info(f'finished sample {probe_num} of {sample_count}')
         gcmd.respond_info(f'pulling probed_results')
         positions = probe_session.pull_probed_results()
         gcmd.respond_info(f'probed_results {positions[0]}, {positions[1]}, {positions[2]}')
         probe_session.end_probe_session(direction)
-        # Calculate maximum, minimum and average values
-        max_value = max([p[axis] for p in positions])
-        min_value = min([p[axis] for p in positions])
+        # Calculate maximum, minimum and average values in a single pass
+        max_value = min_value = positions[0][axis]
+        axis_sum = 0.
+        for p in positions:
+            value = p[axis]
+            axis_sum += value
+            if value < min_value:
+                min_value = value
+            elif value > max_value:
+                max_value = value
         range_value = max_value - min_value
-        avg_value = self.calc_probe_average(positions, 'average')[axis]
-        median = self.calc_probe_average(positions, 'median')[axis]
+        avg_value = axis_sum / len(positions)
+        median = calc_probe_median(positions, axis)[axis]
         # calculate the standard deviation
-        deviation_sum = 0
-        for i in range(len(positions)):
-            deviation_sum += pow(positions[i][2] - avg_value, 2.)
+        deviation_sum = 0.
+        for p in positions:
+            deviation = p[axis] - avg_value
+            deviation_sum += deviation * deviation
         sigma = (deviation_sum / len(positions)) ** 0.5
         # Show information
         gcmd.respond_info(
@@ -101,19 +148,6 @@ class ProbeCommandHelper:
             "average %.6f, median %.6f, standard deviation %.6f" % (
             max_value, min_value, range_value, avg_value, median, sigma))
 
-    def calc_probe_average(self, positions, method='average'):
-        if method != 'median':
-            count = float(len(positions))
-            return [sum([pos[i] for pos in positions]) / count
-                    for i in range(3)]
-        z_sorted = sorted(positions, key=(lambda p: p[2]))
-        middle = len(positions) // 2
-        if (len(positions) & 1) == 1:
-            # odd number of samples
-            return z_sorted[middle]
-        # even number of samples
-        return self.calc_probe_average(z_sorted[middle-1:middle+1], 'average')
-
 
 class HomingViaProbeHelper:
     def __init__(self, config, mcu_probe):
@@ -175,8 +209,8 @@ class ProbeSessionHelper:
     def __init__(self, config, mcu_probes):
         self.printer = config.get_printer()
         self.mcu_probes = mcu_probes
-        gcode = self.printer.lookup_object('gcode')
-        self.dummy_gcode_cmd = gcode.create_gcode_command("", "", {})
+        self.gcode = self.printer.lookup_object('gcode')
+        self.dummy_gcode_cmd = self.gcode.create_gcode_command("", "", {})
         self.homing_helper = HomingViaProbeHelper(config, self.mcu_probes[2])
 
         self.speed = config.getfloat('speed', 5.0, above=0.)
@@ -194,6 +228,9 @@ class ProbeSessionHelper:
         self.samples_retries = config.getint('samples_tolerance_retries', 0, minval=0)
 
         self.multi_probe_pending = False
+        self.session_axis = 2
+        self.toolhead = None
+        self.axis_minimum = self.axis_maximum = None
         self.results = []
 
         self.printer.register_event_handler("gcode:command_error",
@@ -213,8 +250,20 @@ class ProbeSessionHelper:
     def start_probe_session(self, gcmd, direction='z-'):
         if self.multi_probe_pending:
             self._probe_state_error()
-        (axis, sense) = direction_types[direction]
-        self.mcu_probes[axis].multi_probe_begin()
+        axis_sense = direction_types.get(direction)
+        if axis_sense is None:
+            raise self.printer.command_error("Wrong value for DIRECTION.")
+        self.session_axis = axis_sense[0]
+        self.toolhead = self.printer.lookup_object('toolhead')
+        # Axis limits do not change during a session
+        curtime = self.printer.get_reactor().monotonic()
+        kin_status = self.toolhead.get_kinematics().get_status(curtime)
+        if 'axis_minimum' not in kin_status or 'axis_maximum' not in kin_status:
+            raise self.gcode.error(
+                "Tools calibrate only works with cartesian kinematics")
+        self.axis_minimum = kin_status['axis_minimum']
+        self.axis_maximum = kin_status['axis_maximum']
+        self.mcu_probes[self.session_axis].multi_probe_begin()
         self.multi_probe_pending = True
         self.results = []
         return self
@@ -222,10 +271,10 @@ class ProbeSessionHelper:
     def end_probe_session(self, direction='z-'):
         if not self.multi_probe_pending:
             self._probe_state_error()
-        (axis, sense) = direction_types[direction]
+        # Always end on the probe the session was started with
         self.results = []
         self.multi_probe_pending = False
-        self.mcu_probes[axis].multi_probe_end()
+        self.mcu_probes[self.session_axis].multi_probe_end()
 
     def get_probe_params(self, gcmd=None):
         if gcmd is None:
@@ -257,71 +306,85 @@ class ProbeSessionHelper:
                 'samples_result': samples_result}
 
     def run_probe(self, gcmd, direction='z-'):
+        params = self.get_probe_params(gcmd)
+        return self.run_probe_with_params(gcmd, params, direction)
+
+    def run_probe_with_params(self, gcmd, params, direction='z-'):
         if not self.multi_probe_pending:
             self._probe_state_error()
-        params = self.get_probe_params(gcmd)
-        if direction not in direction_types:
+        axis_sense = direction_types.get(direction)
+        if axis_sense is None:
             raise self.printer.command_error("Wrong value for DIRECTION.")
-        logging.info("run_probe direction = " + str(direction))
-        (axis, sense) = direction_types[direction]
-        logging.info("run_probe axis = %d, sense = %d" % (axis, sense))
-        gcode = self.printer.lookup_object('gcode')
-        gcode.respond_info(f"Probing {axis} axis with {sense} sense")
-        toolhead = self.printer.lookup_object('toolhead')
-        start_position = self.printer.lookup_object('toolhead').get_position()
-        probe_speed = params['probe_speed'] * 0.4 if direction.startswith('z') else params['probe_speed']
+        (axis, sense) = axis_sense
+        logging.info("run_probe direction = %s, axis = %d, sense = %d",
+                     direction, axis, sense)
+        toolhead = self.toolhead
+        start_position = toolhead.get_position()
+        probe_speed = params['probe_speed']
+        if direction.startswith('z'):
+            probe_speed *= 0.4
+        lift_speed = params['lift_speed']
+        sample_count = params['samples']
+        sample_retract_dist = params['sample_retract_dist']
+        samples_tolerance = params['samples_tolerance']
+        samples_retries = params['samples_tolerance_retries']
         retries = 0
         positions = []
-        sample_count = params['samples']
+        min_value, max_value = float('inf'), float('-inf')
         while len(positions) < sample_count:
             # Probe position
-            pos = self._bouncing_probe(probe_speed, direction)
+            pos = self._bouncing_probe(probe_speed, direction, axis, sense)
             positions.append(pos)
             # Check samples tolerance
-            axis_positions = [p[axis] for p in positions]
-            if max(axis_positions)-min(axis_positions) > params['samples_tolerance']:
-                if retries >= params['samples_tolerance_retries']:
+            value = pos[axis]
+            if value < min_value:
+                min_value = value
+            if value > max_value:
+                max_value = value
+            if max_value - min_value > samples_tolerance:
+                if retries >= samples_retries:
                     raise gcmd.error("Probe samples exceed samples_tolerance")
                 gcmd.respond_info("Probe samples exceed tolerance. Retrying...")
                 retries += 1
                 positions = []
+                min_value, max_value = float('inf'), float('-inf')
             # Retract
             if len(positions) < sample_count:
-                liftpos = start_position
-                liftpos[axis] = pos[axis] - sense * params['sample_retract_dist']
-                toolhead.manual_move(liftpos, params['lift_speed'])
+                liftpos = list(start_position)
+                liftpos[axis] = pos[axis] - sense * sample_retract_dist
+                toolhead.manual_move(liftpos, lift_speed)
 
         # Calculate result
-        result_position = self._calculate_results(positions, params['samples_result'], axis)
+        if sample_count == 1:
+            result_position = list(positions[0])
+        else:
+            result_position = self._calculate_results(positions, params['samples_result'], axis)
         self.results.append(result_position)
         return result_position
 
-    def _bouncing_probe(self, speed, direction='z-'):
-        toolhead = self.printer.lookup_object('toolhead')
-        gcode = self.printer.lookup_object('gcode')
-        probe_start = toolhead.get_position()
-        (axis, sense) = direction_types[direction]
+    def _bouncing_probe(self, speed, direction, axis, sense):
+        probe_start = self.toolhead.get_position()
+        manual_move = self.toolhead.manual_move
         bounce_count = self.bounce_count
         bounces = 0
         bouncing_speed = speed
         bouncing_lift_speed = speed
         while bounces < bounce_count:
-            pos = self._probe(bouncing_speed, direction)
+            pos = self._probe(bouncing_speed, axis, sense)
             bouncing_retract_dist = bouncing_speed * self.bounce_distance_ratio
             bouncing_speed = bouncing_speed * self.bounce_speed_ratio
-            liftpos = probe_start
+            liftpos = list(probe_start)
             liftpos[axis] = pos[axis] - sense * bouncing_retract_dist
-            toolhead.manual_move(liftpos, bouncing_lift_speed)
+            manual_move(liftpos, bouncing_lift_speed)
             bounces += 1
         # Allow axis_twist_compensation to update results
         self.printer.send_event("probe:update_results", pos)
-        gcode.respond_info(f"Probe made contact in {direction} direction at {pos[0]},{pos[1]},{pos[2]}")
+        self.gcode.respond_info(f"Probe made contact in {direction} direction at {pos[0]},{pos[1]},{pos[2]}")
         return pos
 
-    def _probe(self, speed, direction='z-'):
+    def _probe(self, speed, axis, sense):
         self.check_homed()
-        (axis, sense) = direction_types[direction]
-        pos = self._get_target_position(direction)
+        pos = self._get_target_position(axis, sense)
         try:
             epos = self.mcu_probes[axis].probing_move(pos, speed)
         except self.printer.command_error as e:
@@ -332,46 +395,25 @@ class ProbeSessionHelper:
         return epos[:3]
 
     def check_homed(self):
-        toolhead = self.printer.lookup_object('toolhead')
         curtime = self.printer.get_reactor().monotonic()
-        if 'x' not in toolhead.get_status(curtime)['homed_axes'] or \
-                'y' not in toolhead.get_status(curtime)['homed_axes'] or \
-                'z' not in toolhead.get_status(curtime)['homed_axes']:
+        homed_axes = self.toolhead.get_status(curtime)['homed_axes']
+        if 'x' not in homed_axes or 'y' not in homed_axes or 'z' not in homed_axes:
             raise self.printer.command_error("Must home before probe")
         
-    def _get_target_position(self, direction):
-        toolhead = self.printer.lookup_object('toolhead')
-        curtime = self.printer.get_reactor().monotonic()
-        (axis, sense) = direction_types[direction]
-        pos = toolhead.get_position()
-        kin_status = toolhead.get_kinematics().get_status(curtime)
-        if 'axis_minimum' not in kin_status or 'axis_minimum' not in kin_status:
-            raise self.gcode.error(
-                "Tools calibrate only works with cartesian kinematics")
+    def _get_target_position(self, axis, sense):
+        pos = self.toolhead.get_position()
         if sense > 0:
             pos[axis] = min(pos[axis] + self.max_distance,
-                            kin_status['axis_maximum'][axis])
+                            self.axis_maximum[axis])
         else:
             pos[axis] = max(pos[axis] - self.max_distance,
-                            kin_status['axis_minimum'][axis])
+                            self.axis_minimum[axis])
         return pos
 
     def _calculate_results(self, positions, samples_result, axis):
         if samples_result == 'median':
-            return self._calc_median(positions, axis)
-        return self._calc_mean(positions)
-
-    def _calc_mean(self, positions):
-        count = float(len(positions))
-        return [sum([pos[i] for pos in positions]) / count
-                for i in range(3)]
-
-    def _calc_median(self, positions, axis):
-        axis_sorted = sorted(positions, key=(lambda p: p[axis]))
-        middle = len(positions) // 2
-        if (len(positions) & 1) == 1:
-            return axis_sorted[middle]
-        return self._calc_mean(axis_sorted[middle - 1:middle + 1])
+            return calc_probe_median(positions, axis)
+        return calc_probe_mean(positions)
 
     def pull_probed_results(self):
         res = self.results
@@ -383,8 +425,9 @@ class ProbeOffsetsHelper:
         self.x_offset = config.getfloat('x_offset', 0.)
         self.y_offset = config.getfloat('y_offset', 0.)
         self.z_offset = config.getfloat('z_offset')
+        self.offsets = (self.x_offset, self.y_offset, self.z_offset)
     def get_offsets(self):
-        return self.x_offset, self.y_offset, self.z_offset
+        return self.offsets
 
 
 class ProbePointsHelper:
@@ -394,6 +437,8 @@ class ProbePointsHelper:
         self.probe_points = default_points
         self.name = config.get_name()
         self.gcode = self.printer.lookup_object('gcode')
+        self.toolhead = None
+        self.printer.register_event_handler('klippy:connect', self._handle_connect)
         # Read config settings
         if default_points is None or config.get('points', None) is not None:
             self.probe_points = config.getlists('points', seps=(',', '\n'),
@@ -405,8 +450,12 @@ class ProbePointsHelper:
         # Internal probing state
         self.lift_speed = self.speed
         self.probe_offsets = (0., 0., 0.)
+        self.adjusted_points = []
         self.manual_results = []
 
+    def _handle_connect(self):
+        self.toolhead = self.printer.lookup_object('toolhead')
+
     def minimum_points(self,n):
         if len(self.probe_points) < n:
             raise self.printer.config_error(
@@ -423,7 +472,7 @@ class ProbePointsHelper:
         return self.lift_speed
 
     def _move(self, coord, speed):
-        self.printer.lookup_object('toolhead').manual_move(coord, speed)
+        self.toolhead.manual_move(coord, speed)
 
     def _raise_tool(self, is_first=False):
         speed = self.lift_speed
@@ -432,17 +481,18 @@ class ProbePointsHelper:
         self._move([None, None, self.horizontal_move_z], speed)
 
     def _invoke_callback(self, results):
-        toolhead = self.printer.lookup_object('toolhead')
-        toolhead.get_last_move_time()
+        self.toolhead.get_last_move_time()
         res = self.finalize_callback(self.probe_offsets, results)
         return res != "retry"
 
+    def _adjust_points(self):
+        if not self.use_offsets:
+            return self.probe_points
+        x_offset, y_offset = self.probe_offsets[:2]
+        return [[x - x_offset, y - y_offset] for x, y in self.probe_points]
+
     def _move_next(self, probe_num):
-        nextpos = list(self.probe_points[probe_num])
-        if self.use_offsets:
-            nextpos[0] -= self.probe_offsets[0]
-            nextpos[1] -= self.probe_offsets[1]
-        self._move(nextpos, self.speed)
+        self._move(self.adjusted_points[probe_num], self.speed)
 
     def start_probe(self, gcmd):
         # Lookup objects
@@ -455,6 +505,7 @@ class ProbePointsHelper:
         self.probe_offsets = probe.get_offsets()
         if self.horizontal_move_z < self.probe_offsets[2]:
             raise gcmd.error("horizontal_move_z can't be less than probe's z_offset")
+        self.adjusted_points = self._adjust_points()
         probe_session = probe.start_probe_session(gcmd, 'z-')
         probe_num = 0
         while 1:
@@ -501,15 +552,16 @@ class ProbeEndstopWrapper:
         self.query_endstop = self.mcu_endstop.query_endstop
         # multi probes state
         self.multi = 'OFF'
+        self.toolhead = None
     def _raise_probe(self):
-        toolhead = self.printer.lookup_object('toolhead')
+        toolhead = self.toolhead
         start_pos = toolhead.get_position()
         self.deactivate_gcode.run_gcode_from_command()
         if toolhead.get_position()[:3] != start_pos[:3]:
             raise self.printer.command_error(
                 "Toolhead moved during probe deactivate_gcode script")
     def _lower_probe(self):
-        toolhead = self.printer.lookup_object('toolhead')
+        toolhead = self.toolhead
         start_pos = toolhead.get_position()
         self.activate_gcode.run_gcode_from_command()
         if toolhead.get_position()[:3] != start_pos[:3]:
@@ -525,7 +577,6 @@ class ProbeEndstopWrapper:
         self._raise_probe()
         self.multi = 'OFF'
     def probing_move(self, pos, speed):
-        gcode = self.printer.lookup_object('gcode')
         phoming = self.printer.lookup_object('homing')
         return phoming.probing_move(self, pos, speed)
     def probe_prepare(self, hmove):
@@ -540,7 +591,8 @@ class ProbeEndstopWrapper:
         return self.position_endstop
 
     def _handle_mcu_identify(self):
-        kin = self.printer.lookup_object('toolhead').get_kinematics()
+        self.toolhead = self.printer.lookup_object('toolhead')
+        kin = self.toolhead.get_kinematics()
         for stepper in kin.get_steppers():
             if stepper.is_active_axis(self.axis_name):
                 self.add_stepper(stepper)
@@ -1,5 +1,5 @@
-direction_types = {'x+': [0, +1], 'x-': [0, -1], 'y+': [1, +1], 'y-': [1, -1],
-                   'z+': [2, +1], 'z-': [2, -1]}
+direction_types = {'x+': (0, +1), 'x-': (0, -1), 'y+': (1, +1), 'y-': (1, -1),
+                   'z+': (2, +1), 'z-': (2, -1)}
 
 class ToolProbe:
     def __init__(self, config):